@@ -1,9 +1,11 @@
 import streamlit as st
 import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
+import numpy as np
 import os
 import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from typing import Optional, Tuple
 from datetime import datetime
@@ -15,6 +17,10 @@ from zoneinfo import ZoneInfo
 SHEET_ID = "1EMuK_cXYR2kk_Gb_i7MIOpnmfhC4Q2c9Uh5dUqpz7cc"
 SHEET_NAME = "devicestatus"
 REQUIRED_COLUMNS = ["Serial Number", "Device Name", "Status", "Last Scanned/Added", "Scanned/Added By"]
+DESTROY_LOG_SHEET = "destroy_log"
+DESTROY_LOG_COLUMNS = ["Serial Number", "Device Name", "Destroyed At", "By"]
+DATA_TTL_SECONDS = 1000
+LOCAL_TZ = ZoneInfo("Asia/Bangkok")
 
 class DeviceStatus(Enum):
     READY = "Ready"
@@ -31,6 +37,13 @@ class StatusIcon(Enum):
 # ============================================
 @st.cache_resource
 def get_google_sheets_client():
+    # import ตอนใช้ครั้งแรก (ฟังก์ชันนี้ถูก cache ไว้ จึงเรียกแค่ครั้งเดียว)
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
     try:
         # อ่านจาก Streamlit secrets (Streamlit Cloud)
         creds_dict = st.secrets.get("gsheet_creds")
@@ -41,35 +54,83 @@ def get_google_sheets_client():
             creds_dict,
             scopes=["https://www.googleapis.com/auth/spreadsheets"]
         )
-        client = gspread.authorize(credentials)
+        # ใช้ session เดียวกันทุก request (keep-alive + token cache + retry)
+        session = AuthorizedSession(credentials)
+        session.mount("https://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        ))
+        client = gspread.Client(auth=credentials, session=session)
         return client
     except Exception as e:
         st.error(f"Failed to load Google Sheets credentials: {e}")
         return None
 
-def get_worksheet():
-    """Get the worksheet object for main device sheet (create if missing)"""
+@st.cache_resource(show_spinner=False, validate=lambda ss: ss is not None)
+def get_spreadsheet():
+    """Get the spreadsheet handle (opened once and shared)"""
     try:
         client = get_google_sheets_client()
         if not client:
             return None
 
-        spreadsheet = client.open_by_key(SHEET_ID)
+        return client.open_by_key(SHEET_ID)
+
+    except Exception as e:
+        st.error(f"❌ Failed to access Google Sheet: {str(e)}")
+        return None
 
-        try:
-            worksheet = spreadsheet.worksheet(SHEET_NAME)
-            return worksheet
 
-        except gspread.exceptions.WorksheetNotFound:
-            # ถ้า worksheet ยังไม่มี ให้สร้างใหม่
+@st.cache_resource(show_spinner=False, validate=bool)
+def ensure_worksheets() -> bool:
+    """Create the main and destroy_log worksheets if missing (runs once)"""
+    try:
+        spreadsheet = get_spreadsheet()
+        if not spreadsheet:
+            return False
+
+        existing = {ws.title for ws in spreadsheet.worksheets()}
+
+        # ถ้า worksheet ยังไม่มี ให้สร้างใหม่พร้อม header
+        if SHEET_NAME not in existing:
             worksheet = spreadsheet.add_worksheet(title=SHEET_NAME, rows=1000, cols=20)
             worksheet.append_row(REQUIRED_COLUMNS)
-            return worksheet
+        if DESTROY_LOG_SHEET not in existing:
+            ws = spreadsheet.add_worksheet(DESTROY_LOG_SHEET, rows=1000, cols=10)
+            ws.append_row(DESTROY_LOG_COLUMNS)
+
+        return True
+
+    except Exception as e:
+        st.error(f"❌ Failed to access Google Sheet: {str(e)}")
+        return False
+
+
+def _open_worksheet(title: str):
+    try:
+        spreadsheet = get_spreadsheet()
+        if not spreadsheet:
+            return None
+
+        return spreadsheet.worksheet(title)
 
     except Exception as e:
         st.error(f"❌ Failed to access Google Sheet: {str(e)}")
         return None
 
+
+@st.cache_resource(show_spinner=False, validate=lambda ws: ws is not None)
+def get_worksheet():
+    """Get the worksheet object for main device sheet"""
+    return _open_worksheet(SHEET_NAME)
+
+
+@st.cache_resource(show_spinner=False, validate=lambda ws: ws is not None)
+def get_destroy_log_worksheet():
+    """Get the worksheet object for destroy_log sheet"""
+    return _open_worksheet(DESTROY_LOG_SHEET)
+
 # ============================================
 # SESSION STATE INITIALIZATION
 # ============================================
@@ -77,6 +138,8 @@ def init_session_state():
     """Initialize all session state variables"""
     if 'data_refresh' not in st.session_state:
         st.session_state.data_refresh = 0
+    if 'loaded_refresh' not in st.session_state:
+        st.session_state.loaded_refresh = 0
     if 'last_scan' not in st.session_state:
         st.session_state.last_scan = None
     if 'scan_count' not in st.session_state:
@@ -89,53 +152,201 @@ init_session_state()
 # ============================================
 # DATA MANAGEMENT (Google Sheets)
 # ============================================
-@st.cache_data(ttl=1000)
-def load_data():
-    """Load data from Google Sheets with caching"""
+logger = logging.getLogger(__name__)
+
+
+@st.cache_resource
+def _get_data_cache() -> dict:
+    """Shared (cross-session) slot holding the last loaded DataFrame"""
+    return {
+        "lock": threading.Lock(),
+        "executor": ThreadPoolExecutor(max_workers=1),
+        "df": None,
+        "serial_lookup": None,
+        "destroyed_serials": None,
+        "fetched_at": 0.0,
+        "generation": 0,
+        "refreshing": False,
+        "last_error": None,
+    }
+
+
+def _fetch_data(worksheet) -> Tuple[pd.DataFrame, Optional[dict], Optional[list]]:
+    """Read the main sheet (+ destroy_log serials) into a DataFrame and serial lookup (no Streamlit calls, thread-safe)"""
+    from gspread.exceptions import APIError
+
+    # FORMATTED_VALUE (ค่า default เหมือน gspread) -> วันที่ที่พิมพ์เองในชีทยังเป็นข้อความ ไม่ใช่ serial number
+    try:
+        # main sheet + คอลัมน์ serial ของ destroy_log ใน request เดียว
+        resp = worksheet.spreadsheet.values_batch_get([f"{SHEET_NAME}!A:E", f"{DESTROY_LOG_SHEET}!A:A"])
+        main_range, destroy_range = resp["valueRanges"]
+        destroyed_serials = [row[0] if row else "" for row in destroy_range.get("values", [])[1:]]
+    except APIError as e:
+        # เฉพาะกรณี destroy_log หาย/ถูกเปลี่ยนชื่อ -> โหลด main sheet อย่างเดียว (ไม่รู้จำนวน destroy)
+        if e.response.status_code != 400 or "Unable to parse range" not in str(e):
+            raise
+        main_range = worksheet.spreadsheet.values_get(f"{SHEET_NAME}!A:E")
+        destroyed_serials = None
+
+    values = main_range.get("values", [])
+
+    if not values:
+        worksheet.append_row(REQUIRED_COLUMNS)
+        return pd.DataFrame(columns=REQUIRED_COLUMNS), None, destroyed_serials
+
+    header, rows = values[0], values[1:]
+    # header อาจสั้นกว่าแถวข้อมูล (เช่น E1 ว่าง) -> เติมชื่อคอลัมน์ให้กว้างเท่ากัน
+    width = max([len(header)] + [len(row) for row in rows])
+    header = header + [f"_extra{i}" for i in range(len(header), width)]
+    df = pd.DataFrame(rows, columns=header).reindex(columns=REQUIRED_COLUMNS, fill_value="")
+
+    # API ตัดเซลล์ว่างท้ายแถวออก -> เติมเป็น "" ให้เหมือน get_all_records
+    df = df.fillna("")
+    # parse เวลาไว้ครั้งเดียวต่อการโหลด ใช้เรียง Recently Scanned
+    df["_ts"] = pd.to_datetime(df["Last Scanned/Added"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    # คอลัมน์ที่มีค่าซ้ำน้อยแบบ -> category (เทียบค่าด้วย int codes, ใช้ memory น้อยกว่า)
+    df["Status"] = df["Status"].astype("category")
+    df["Scanned/Added By"] = df["Scanned/Added By"].astype("category")
+    return df, build_serial_lookup(df), destroyed_serials
+
+
+def _refresh_data(cache: dict, worksheet, generation: int):
+    """Background refresh: replace the cached DataFrame unless invalidated meanwhile"""
+    try:
+        df, serial_lookup, destroyed_serials = _fetch_data(worksheet)
+        with cache["lock"]:
+            if cache["generation"] == generation:
+                cache["df"] = df
+                cache["serial_lookup"] = serial_lookup
+                cache["destroyed_serials"] = destroyed_serials
+                cache["fetched_at"] = time.time()
+                cache["last_error"] = None
+    except Exception as e:
+        # เก็บข้อมูลเก่าไว้ใช้ต่อ รอบถัดไปจะลองใหม่ (ถ้าเก่าเกินไป load_data จะโหลดแบบรอและแสดง error)
+        logger.exception("Background refresh of device data failed")
+        with cache["lock"]:
+            cache["last_error"] = e
+    finally:
+        with cache["lock"]:
+            cache["refreshing"] = False
+
+
+def load_data(data_refresh: int = 0) -> pd.DataFrame:
+    """Load data from Google Sheets, serving stale data while refreshing in background (re-read after a data_refresh bump)"""
+    st.session_state.serial_lookup = None
     worksheet = get_worksheet()
     if not worksheet:
         return pd.DataFrame(columns=REQUIRED_COLUMNS)
 
-    try:
-        data = worksheet.get_all_records()
-
-        if not data:
-            worksheet.append_row(REQUIRED_COLUMNS)
+    cache = _get_data_cache()
+    with cache["lock"]:
+        df, serial_lookup, fetched_at = cache["df"], cache["serial_lookup"], cache["fetched_at"]
+        destroyed_serials = cache["destroyed_serials"]
+        if st.session_state.get("loaded_refresh", 0) != data_refresh:
+            # session นี้เพิ่งเขียนข้อมูล -> ทิ้งข้อมูลเก่าและ refresh ที่ค้างอยู่
+            df = None
+            cache["generation"] += 1
+        elif df is not None and cache["last_error"] is not None and time.time() - fetched_at > 2 * DATA_TTL_SECONDS:
+            # background refresh ล้มเหลวมานานเกินไป -> โหลดแบบรอเพื่อให้เห็น error
+            df = None
+        elif df is not None and time.time() - fetched_at > DATA_TTL_SECONDS and not cache["refreshing"]:
+            cache["refreshing"] = True
+            cache["executor"].submit(_refresh_data, cache, worksheet, cache["generation"])
+
+    # โหลดครั้งแรก (หรือหลังเขียนข้อมูล) ต้องรอข้อมูลจริง
+    if df is None:
+        try:
+            df, serial_lookup, destroyed_serials = _fetch_data(worksheet)
+        except Exception as e:
+            logger.exception("Loading device data failed")
+            with cache["lock"]:
+                cache["last_error"] = e
+            st.error(f"❌ Error loading data from sheets: {str(e)}")
             return pd.DataFrame(columns=REQUIRED_COLUMNS)
 
-        df = pd.DataFrame(data)
+        fetched_at = time.time()
+        with cache["lock"]:
+            cache["df"] = df
+            cache["serial_lookup"] = serial_lookup
+            cache["destroyed_serials"] = destroyed_serials
+            cache["fetched_at"] = fetched_at
+            cache["last_error"] = None
 
-        for col in REQUIRED_COLUMNS:
-            if col not in df.columns:
-                df[col] = ""
+    st.session_state.loaded_refresh = data_refresh
+    st.session_state.data_fetched_at = fetched_at
+    st.session_state.destroyed_serials = destroyed_serials
 
-        return df
+    df = df.copy()
+    # lookup ผูกกับ frame ที่คืนไปนี้เท่านั้น ไม่เก็บใน df.attrs เพราะ pandas deep-copy attrs ทุกครั้งที่สร้าง object ใหม่
+    if serial_lookup is not None:
+        st.session_state.serial_lookup = dict(serial_lookup, frame_id=id(df), fetched_at=fetched_at)
 
-    except Exception as e:
-        st.error(f"❌ Error loading data from sheets: {str(e)}")
-        return pd.DataFrame(columns=REQUIRED_COLUMNS)
+    return df
+
+
+def invalidate_data():
+    """Force the next load_data call to re-read the sheet"""
+    st.session_state.data_refresh += 1
 
 
-def save_data(df: pd.DataFrame) -> bool:
-    """Save DataFrame to Google Sheets"""
+def get_sheet_row(idx: int) -> int:
+    """Map a DataFrame index to its sheet row (row 1 is the header)"""
+    return idx + 2
+
+
+def append_device_row(row: list) -> bool:
+    """Append a single device row to the bottom of the sheet"""
     worksheet = get_worksheet()
     if not worksheet:
         return False
 
     try:
-        worksheet.clear()
-        worksheet.append_row(REQUIRED_COLUMNS)
-        if not df.empty:
-            data = df[REQUIRED_COLUMNS].values.tolist()
+        worksheet.append_row(row, value_input_option='RAW', table_range='A1')
+        invalidate_data()
+        return True
+
+    except Exception as e:
+        st.error(f"❌ Error saving data to sheets: {str(e)}")
+        return False
+
+
+def verify_device_row(worksheet, row: int, serial) -> bool:
+    """Re-read the header and column A of row; refuse positional writes if the sheet no longer matches"""
+    resp = worksheet.spreadsheet.values_batch_get([f"{SHEET_NAME}!A1:E1", f"{SHEET_NAME}!A{row}"])
+    header_range, row_range = resp["valueRanges"]
+    header = (header_range.get("values") or [[]])[0]
+    current = (row_range.get("values") or [[""]])[0]
+
+    if header != REQUIRED_COLUMNS:
+        st.error(f"❌ Sheet columns must be in this order: {', '.join(REQUIRED_COLUMNS)}")
+        return False
+
+    # ข้อมูลที่โหลดไว้อาจเก่า -> แถวนี้ต้องยังเป็น serial เดิม ไม่งั้นจะเขียนทับเครื่องอื่น
+    if not current or str(current[0]) != str(serial):
+        st.error(f"❌ Sheet changed since it was loaded ({serial} is no longer on row {row}). Please try again.")
+        invalidate_data()
+        return False
 
-            batch_size = 100
-            for i in range(0, len(data), batch_size):
-                batch = data[i:i + batch_size]
-                worksheet.append_rows(batch, value_input_option='RAW')
+    return True
 
-        st.cache_data.clear()
-        st.session_state.data_refresh += 1
 
+def update_device_row(idx: int, serial, values: list, first_col: str = "A") -> bool:
+    """Overwrite cells of the row holding serial, starting at first_col"""
+    worksheet = get_worksheet()
+    if not worksheet:
+        return False
+
+    try:
+        row = get_sheet_row(idx)
+        if not verify_device_row(worksheet, row, serial):
+            return False
+
+        last_col = chr(ord(first_col) + len(values) - 1)
+        worksheet.batch_update(
+            [{'range': f"{first_col}{row}:{last_col}{row}", 'values': [values]}],
+            value_input_option='RAW'
+        )
+        invalidate_data()
         return True
 
     except Exception as e:
@@ -145,62 +356,94 @@ def save_data(df: pd.DataFrame) -> bool:
 # ============================================
 # DESTROY LOG: store history of destroyed devices
 # ============================================
-def log_destroy(serial):
-    """Save destroyed device details into destroy_log sheet"""
+def destroy_device(idx: int, device: pd.Series) -> bool:
+    """Log device into destroy_log and delete its main sheet row in one batchUpdate"""
+    worksheet = get_worksheet()
+    ws = get_destroy_log_worksheet()
+    if not worksheet or not ws:
+        return False
+
     try:
-        client = get_google_sheets_client()
-        if not client:
+        row = get_sheet_row(idx)
+        if not verify_device_row(worksheet, row, device["Serial Number"]):
             return False
 
-        spreadsheet = client.open_by_key(SHEET_ID)
-
-        # เปิดชีท destroy_log ถ้าไม่มีให้สร้างใหม่พร้อม header
-        try:
-            ws = spreadsheet.worksheet("destroy_log")
-        except gspread.exceptions.WorksheetNotFound:
-            ws = spreadsheet.add_worksheet("destroy_log", rows=1000, cols=10)
-            ws.append_row(["Serial Number", "Device Name", "Destroyed At", "By"])
-
-        # อ่าน device name จาก main sheet ก่อนทำลาย
-        main_ws = spreadsheet.worksheet("devicestatus")
-        main_data = main_ws.get_all_records()
-
-        device_name = "Unknown"
-        for row in main_data:
-            if str(row["Serial Number"]).upper() == str(serial).upper():
-                device_name = row.get("Device Name", "Unknown")
-                break
-
-        # บันทึกลง log
-        ws.append_row([
-            serial,
-            device_name,
-            datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d %H:%M:%S"),
+        log_row = [
+            device["Serial Number"],
+            device.get("Device Name") or "Unknown",
+            datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S"),
             st.session_state.get("username", "unknown")
-        ])
-
+        ]
+
+        # append log + ลบแถวจาก main sheet ใน request เดียว (atomic)
+        get_spreadsheet().batch_update({"requests": [
+            {"appendCells": {
+                "sheetId": ws.id,
+                "rows": [{"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in log_row]}],
+                "fields": "userEnteredValue",
+            }},
+            {"deleteDimension": {"range": {
+                "sheetId": worksheet.id,
+                "dimension": "ROWS",
+                "startIndex": row - 1,
+                "endIndex": row,
+            }}},
+        ]})
+
+        invalidate_data()
         return True
 
     except Exception as e:
-        st.error(f"❌ Failed to log destroy: {e}")
+        st.error(f"❌ Failed to destroy device: {e}")
         return False
 
 
-def count_destroyed():
-    """Count all logged destroys in destroy_log sheet"""
-    try:
-        client = get_google_sheets_client()
-        if not client:
-            return 0
-        spreadsheet = client.open_by_key(SHEET_ID)
-        try:
-            ws = spreadsheet.worksheet("destroy_log")
-            data = ws.get_all_records()
-            return len(data)
-        except gspread.exceptions.WorksheetNotFound:
-            return 0
-    except Exception:
-        return 0
+def _read_destroy_log_row(ws, serials: list, key: str) -> Tuple[Optional[dict], bool]:
+    """Find key in a destroy_log serial column and read its row; flag if that row no longer holds key"""
+    for i, value in enumerate(serials, start=2):
+        if str(value).upper() == key:
+            values = ws.row_values(i)
+            if values and str(values[0]).upper() == key:
+                return dict(zip(DESTROY_LOG_COLUMNS, values)), False
+            return None, True
+    return None, False
+
+
+def find_destroyed_device(serial: str) -> Optional[dict]:
+    """Look up a serial in destroy_log (results cached per data load in session state)"""
+    fetched_at = st.session_state.get("data_fetched_at")
+    cache = st.session_state.get("destroy_lookup")
+    if cache is None or cache["fetched_at"] != fetched_at:
+        cache = {"fetched_at": fetched_at, "results": {}}
+        st.session_state.destroy_lookup = cache
+
+    key = serial.upper()
+    if key in cache["results"]:
+        return cache["results"][key]
+
+    ws = get_destroy_log_worksheet()
+    if not ws:
+        return None
+
+    # ใช้คอลัมน์ serial ที่โหลดมาพร้อม load_data (ถ้าไม่มีค่อยอ่านเอง) แล้วดึงเฉพาะแถวที่เจอ
+    serials = st.session_state.get("destroyed_serials")
+    if serials is None:
+        serials = ws.col_values(1)[1:]
+
+    row, moved = _read_destroy_log_row(ws, serials, key)
+    if moved:
+        # แถวถูกลบ/เรียงใหม่ระหว่างสอง request -> อ่านคอลัมน์ใหม่แล้วหาอีกครั้ง
+        row, moved = _read_destroy_log_row(ws, ws.col_values(1)[1:], key)
+
+    if not moved:
+        cache["results"][key] = row
+    return row
+
+
+def count_destroyed() -> int:
+    """Count all logged destroys in destroy_log sheet (read together with load_data)"""
+    serials = st.session_state.get("destroyed_serials")
+    return len(serials) if serials is not None else 0
 
 # ============================================
 # UTILITY FUNCTIONS
@@ -215,23 +458,55 @@ def get_status_icon(status: str) -> str:
     return status_map.get(status, "❓")
 
 
+def build_serial_lookup(df: pd.DataFrame) -> dict:
+    """Precompute upper-cased serials and a serial -> row position lookup for df"""
+    serial_upper = np.char.upper(df["Serial Number"].astype(str).to_numpy(dtype=str))
+    # เก็บตำแหน่งแรกของ serial ที่ซ้ำ (เหมือน matching.index[0] เดิม)
+    serial_index = {serial_upper[i]: i for i in range(len(serial_upper) - 1, -1, -1)}
+    return {"serial_upper": serial_upper, "serial_index": serial_index}
+
+
+def get_serial_lookup(df: pd.DataFrame) -> dict:
+    """Return the lookup load_data built for this exact frame, or build one for any other frame"""
+    lookup = st.session_state.get("serial_lookup")
+    if (lookup is None or lookup["frame_id"] != id(df)
+            or lookup["fetched_at"] != st.session_state.get("data_fetched_at")):
+        lookup = build_serial_lookup(df)
+    return lookup
+
+
+def get_serial_index(df: pd.DataFrame) -> dict:
+    """Return the serial -> row position dict for df"""
+    return get_serial_lookup(df)["serial_index"]
+
+
+def get_serial_upper(df: pd.DataFrame) -> np.ndarray:
+    """Return the upper-cased serial array (same row order as df)"""
+    return get_serial_lookup(df)["serial_upper"]
+
+
 def find_device_by_serial(df: pd.DataFrame, serial: str) -> Optional[Tuple[pd.Series, int]]:
     if df.empty or not serial.strip():
         return None
 
-    matching = df[df["Serial Number"].astype(str).str.upper() == serial.upper()]
-    if matching.empty:
+    pos = get_serial_index(df).get(serial.upper())
+    if pos is None:
         return None
 
-    idx = matching.index[0]
-    return matching.iloc[0], idx
+    return df.iloc[pos], df.index[pos]
+
+
+def get_status_counts(df: pd.DataFrame) -> dict:
+    """Count devices per status in a single pass over the Status column"""
+    return df["Status"].value_counts().to_dict()
 
 
 def find_similar_serials(df: pd.DataFrame, search_term: str) -> pd.DataFrame:
     if df.empty or not search_term.strip():
         return pd.DataFrame()
 
-    return df[df["Serial Number"].astype(str).str.contains(search_term, case=False, na=False)]
+    mask = np.char.find(get_serial_upper(df), search_term.upper()) >= 0
+    return df[mask]
 
 
 def validate_device_input(serial: str, name: str) -> Tuple[bool, str]:
@@ -248,12 +523,14 @@ def check_duplicate_serial(df: pd.DataFrame, serial: str, exclude_idx: Optional[
     if df.empty:
         return False
 
-    matches = df[df["Serial Number"].astype(str).str.upper() == serial.upper()]
-
-    if exclude_idx is not None:
-        matches = matches[matches.index != exclude_idx]
+    key = serial.upper()
+    if key not in get_serial_index(df):
+        return False
+    if exclude_idx is None:
+        return True
 
-    return not matches.empty
+    matches = np.flatnonzero(get_serial_upper(df) == key)
+    return bool((df.index[matches] != exclude_idx).any())
 
 
 def display_device_info(device: pd.Series):
@@ -292,7 +569,7 @@ def process_barcode_scan(barcode_data: str, df: pd.DataFrame, default_status: st
     if not barcode_data:
         return False, "❌ Empty barcode", df
 
-    timestamp = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
 
     result = find_device_by_serial(df, barcode_data)
 
@@ -300,29 +577,20 @@ def process_barcode_scan(barcode_data: str, df: pd.DataFrame, default_status: st
         device, idx = result
         current_status = device['Status']
         
-        # Cycle to next status
+        # Cycle to next status (df is reloaded on rerun, so only the sheet is written)
         new_status = cycle_status(current_status)
-        df.at[idx, "Status"] = new_status
-        df.at[idx, "Last Scanned/Added"] = timestamp
-        df.at[idx, "Scanned/Added By"] = st.session_state.username
 
-        if save_data(df):
+        if update_device_row(idx, device["Serial Number"], [new_status, timestamp, st.session_state.username], first_col="C"):
             status_icon = get_status_icon(new_status)
             message = f"🔄 Status Updated: {barcode_data} - {status_icon} {new_status}"
             return True, message, df
         else:
             return False, "❌ Failed to update scan info", df
     else:
-        new_row = pd.DataFrame({
-            "Serial Number": [barcode_data],
-            "Device Name": ["Legacy pro"],
-            "Status": [default_status],
-            "Last Scanned/Added": [timestamp],
-            "Scanned/Added By": [st.session_state.username]
-        })
-        df = pd.concat([df, new_row], ignore_index=True)
-
-        if save_data(df):
+        # เขียนลงชีทตรง ๆ แล้วให้ rerun โหลดข้อมูลใหม่ (ไม่ต้อง copy df ทั้งก้อน)
+        new_row = [barcode_data, "Legacy pro", default_status, timestamp, st.session_state.username]
+
+        if append_device_row(new_row):
             message = f"➕ New Device Added: {barcode_data}"
             return True, message, df
         else:
@@ -332,7 +600,6 @@ def process_barcode_scan(barcode_data: str, df: pd.DataFrame, default_status: st
 # MENU: BARCODE SCANNER
 # ============================================
 def menu_barcode_scanner(df: pd.DataFrame) -> pd.DataFrame:
-    st.set_page_config(page_title="APD Device Tracker", layout="wide")
     col1, col2 = st.columns([3, 1])
     with col1:
         st.info("**🔴 LIVE SCANNER MODE** - Auto-save on scan")
@@ -381,19 +648,21 @@ def menu_barcode_scanner(df: pd.DataFrame) -> pd.DataFrame:
 
     st.divider()
     # Statistics
+    status_counts = get_status_counts(df)
     col1, col2, col3, col4 = st.columns(4)
     with col1:
         st.metric("📊 Scans Today", st.session_state.scan_count)
     with col2:
         st.metric("🔧 Total Devices", len(df))
     with col3:
-        st.metric("✅ Ready", (df["Status"] == DeviceStatus.READY.value).sum())
+        st.metric("✅ Ready", status_counts.get(DeviceStatus.READY.value, 0))
     with col4:
-        st.metric("🔄 Return", (df["Status"] == DeviceStatus.RETURN.value).sum())
+        st.metric("🔄 Return", status_counts.get(DeviceStatus.RETURN.value, 0))
 
     st.subheader("📜 Recently Scanned")
     if not df.empty:
-        recent = df.dropna(subset=["Last Scanned/Added"]).sort_values("Last Scanned/Added", ascending=False).head(20)
+        # nlargest เติมแถว NaT ถ้ามีเวลาไม่ถึง 20 แถว -> ตัดทิ้งก่อน
+        recent = df.dropna(subset=["_ts"]).nlargest(20, "_ts")
         if not recent.empty:
             display_cols = ["Serial Number", "Device Name", "Status", "Last Scanned/Added", "Scanned/Added By"]
             def highlight_status(status):
@@ -445,13 +714,14 @@ def menu_view_all(df: pd.DataFrame):
         st.dataframe(styled_df, use_container_width=True, hide_index=True)
 
         # Statistics
+        status_counts = get_status_counts(df)
         col1, col2, col3, col4 = st.columns(4)
         with col1:
             st.metric("🔧 Total", len(df))
         with col2:
-            st.metric("✅ Ready", (df["Status"] == DeviceStatus.READY.value).sum())
+            st.metric("✅ Ready", status_counts.get(DeviceStatus.READY.value, 0))
         with col3:
-            st.metric("🔄 Return", (df["Status"] == DeviceStatus.RETURN.value).sum())
+            st.metric("🔄 Return", status_counts.get(DeviceStatus.RETURN.value, 0))
         with col4:
             st.metric("💥 Destroy", count_destroyed())
 
@@ -461,7 +731,10 @@ def menu_view_all(df: pd.DataFrame):
 def menu_search(df: pd.DataFrame):
     st.subheader("🔍 Search Device")
 
-    search_serial = st.text_input("Enter Serial Number", placeholder="Search...")
+    # ใช้ form เพื่อให้ rerun เฉพาะตอนกด Search/Enter ไม่ใช่ทุกครั้งที่พิมพ์
+    with st.form("search_form"):
+        search_serial = st.text_input("Enter Serial Number", placeholder="Search...")
+        st.form_submit_button("Search")
 
     if not search_serial:
         return
@@ -488,28 +761,22 @@ def menu_search(df: pd.DataFrame):
         return
 
     # ----- 2) ถ้าไม่เจอ → ค้นหาใน destroy_log -----
-    client = get_google_sheets_client()
-
     try:
-        spreadsheet = client.open_by_key(SHEET_ID)
-        ws_destroy = spreadsheet.worksheet("destroy_log")
-        destroy_data = ws_destroy.get_all_records()
-
-        for row in destroy_data:
-            if str(row["Serial Number"]).upper() == search_serial.upper():
+        row = find_destroyed_device(search_serial)
 
-                st.warning(f"💥 This device has been DESTROYED")
+        if row is not None:
+            st.warning(f"💥 This device has been DESTROYED")
 
-                display_destroy_device_info(row)
+            display_destroy_device_info(row)
 
-                st.write("---")
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.write(f"**Destroyed At:** {row.get('Destroyed At','-')}")
-                with col2:
-                    st.write(f"**Destroyed By:** {row.get('By','-')}")
+            st.write("---")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.write(f"**Destroyed At:** {row.get('Destroyed At','-')}")
+            with col2:
+                st.write(f"**Destroyed By:** {row.get('By','-')}")
 
-                return
+            return
 
     except Exception as e:
         st.error(f"⚠ Error reading destroy_log: {e}")
@@ -554,17 +821,10 @@ def menu_add_device(df: pd.DataFrame) -> pd.DataFrame:
                 return df
 
 
-            timestamp = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d %H:%M:%S")
-            new_row = pd.DataFrame({
-                "Serial Number": [new_serial.strip()],
-                "Device Name": [new_name.strip()],
-                "Status": [new_status],
-                "Last Scanned/Added": [timestamp],
-                "Scanned/Added By": [st.session_state.username]
-            })
-            df = pd.concat([df, new_row], ignore_index=True)
+            timestamp = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
+            new_row = [new_serial.strip(), new_name.strip(), new_status, timestamp, st.session_state.username]
 
-            if save_data(df):
+            if append_device_row(new_row):
                 st.success(f"✅ Device added: {new_serial} - {new_name}")
                 st.rerun()
 
@@ -580,7 +840,9 @@ def menu_edit_device(df: pd.DataFrame) -> pd.DataFrame:
         st.info("📭 No devices available. Please add a device first.")
         return df
 
-    edit_serial = st.text_input("🔍 Search Serial Number to edit", key="edit_serial", placeholder="Search...")
+    with st.form("edit_search_form"):
+        edit_serial = st.text_input("🔍 Search Serial Number to edit", key="edit_serial", placeholder="Search...")
+        st.form_submit_button("Search")
 
     if not edit_serial:
         return df
@@ -639,13 +901,15 @@ def menu_edit_device(df: pd.DataFrame) -> pd.DataFrame:
                 st.warning("⚠️ New Serial Number already exists")
                 return df
 
-            df.at[idx, 'Serial Number'] = new_serial.strip()
-            df.at[idx, 'Device Name'] = new_name.strip()
-            df.at[idx, 'Status'] = new_status
-            df.at[idx, 'Last Scanned/Added'] = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d %H:%M:%S")
-            df.at[idx, 'Scanned/Added By'] = st.session_state.username
+            updated_row = [
+                new_serial.strip(),
+                new_name.strip(),
+                new_status,
+                datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S"),
+                st.session_state.username
+            ]
 
-            if save_data(df):
+            if update_device_row(idx, device["Serial Number"], updated_row):
                 st.success("✅ Device updated successfully!")
                 st.balloons()
                 st.rerun()
@@ -662,7 +926,9 @@ def menu_update_status(df: pd.DataFrame) -> pd.DataFrame:
         st.info("📭 No devices available.")
         return df
 
-    update_serial = st.text_input("Enter Serial Number", placeholder="Search...")
+    with st.form("update_search_form"):
+        update_serial = st.text_input("Enter Serial Number", placeholder="Search...")
+        st.form_submit_button("Search")
 
     if not update_serial:
         return df
@@ -706,19 +972,15 @@ def menu_update_status(df: pd.DataFrame) -> pd.DataFrame:
                 st.error("⚠️ Changing to 'Destroy' will delete device from system!")
 
                 if st.checkbox("Confirm destruction", key="confirm_destroy_update"):
-                    # log destroy then remove
-                    log_destroy(update_serial)
-                    df = df[df["Serial Number"].astype(str).str.upper() != update_serial.upper()].reset_index(drop=True)
-                    if save_data(df):
+                    # log destroy and remove in one request
+                    if destroy_device(idx, device):
                         st.success(f"✅ Device destroyed and removed: {update_serial}")
                         st.rerun()
                 return df
 
-            df.loc[idx, "Status"] = new_status
-            df.loc[idx, "Last Scanned/Added"] = datetime.now(ZoneInfo("Asia/Bangkok")).strftime("%Y-%m-%d %H:%M:%S")
-            df.loc[idx, "Scanned/Added By"] = st.session_state.username
+            timestamp = datetime.now(LOCAL_TZ).strftime("%Y-%m-%d %H:%M:%S")
 
-            if save_data(df):
+            if update_device_row(idx, device["Serial Number"], [new_status, timestamp, st.session_state.username], first_col="C"):
                 st.success(f"✅ Status updated: {get_status_icon(new_status)} {new_status}")
                 st.rerun()
 
@@ -732,9 +994,10 @@ def display_sidebar_stats(df: pd.DataFrame):
     st.sidebar.markdown("📊 **System Information**")
 
     if not df.empty:
+        status_counts = get_status_counts(df)
         st.sidebar.metric("Total Devices", len(df))
-        st.sidebar.metric("✅ Ready", (df["Status"] == DeviceStatus.READY.value).sum())
-        st.sidebar.metric("🔄 Return", (df["Status"] == DeviceStatus.RETURN.value).sum())
+        st.sidebar.metric("✅ Ready", status_counts.get(DeviceStatus.READY.value, 0))
+        st.sidebar.metric("🔄 Return", status_counts.get(DeviceStatus.RETURN.value, 0))
         st.sidebar.metric("💥 Destroyed", count_destroyed())
     else:
         st.sidebar.write("📭 No data in system")
@@ -755,7 +1018,7 @@ def main():
     st.title("🧰 APD Device Tracker")
     st.subheader("Google Sheets Backend - Automatic Device Tracking")
 
-    if not get_worksheet():
+    if not ensure_worksheets():
         st.error("""
         ⚠️ **Google Sheets not configured**
 
@@ -767,7 +1030,7 @@ def main():
         """)
         return
 
-    df = load_data()
+    df = load_data(st.session_state.data_refresh)
 
     menu = st.sidebar.radio(
         "Menu",